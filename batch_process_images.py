@@ -1,30 +1,87 @@
 import glob
 import importlib.util
+import io
 import json
 import os
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 import cv2
+import numpy as np
 import requests
-from skimage.metrics import structural_similarity as ssim
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    from turbojpeg import TJPF_BGR, TJSAMP_420, TurboJPEG
+except ImportError:  # Optional; OpenCV encodes the crops when it is missing
+    TurboJPEG = None
+
+from compare_ssim import downsample_for_ssim, fast_ssim_with_stats, ssim_stats
 
 
 # Config
 BUCKET_NAME = "conference-core-backend-prod"
 PREFIX = "audit_test/"
 JSON_FILENAME = "input.json"
-TEMP_DIR = os.path.join(os.path.dirname(__file__), "temp")
 MASKS_DIR = os.path.join(os.path.dirname(__file__), "masks")
 MAX_ROWS = 50
 OPTIONAL_HEADERS = {}
 USE_PRESIGNED_URLS = True
 PRESIGNED_URL_EXPIRY_SECONDS = 3600
 DEDUPLICATE_BY_CONFERENCE_UUID = True
+# Stop trying further models once one scores at least this much. None tries
+# every model; keep it off until a value is calibrated against fast_ssim on
+# real rows, since a wrong-model crop can score well above a noisy right one.
+EARLY_EXIT_THRESHOLD = None
+# Per-model win counts, used to try the historically best models first
+MODEL_STATS_FILENAME = "model_stats.json"
+MAX_WORKERS = 8
+DOWNLOAD_WORKERS = 4
+# How many rows ahead of the crop workers images are downloaded
+PREFETCH_ROWS = 4
+UPLOAD_WORKERS = 16
+CLEANUP_WORKERS = 8
+HTTP_POOL_SIZE = 32
+JPEG_QUALITY = 85
+JPEG_ENCODE_PARAMS = [
+    cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY,
+    cv2.IMWRITE_JPEG_OPTIMIZE, 1,
+    cv2.IMWRITE_JPEG_PROGRESSIVE, 0,
+]
+TRANSFER_CONFIG = TransferConfig(
+    max_concurrency=16,
+    multipart_threshold=8 * 1024 * 1024,
+)
+S3_CLIENT_CONFIG = Config(
+    max_pool_connections=HTTP_POOL_SIZE,
+    retries={"max_attempts": 5, "mode": "adaptive"},
+)
+
+
+def _build_http_session():
+    # One pooled session so downloads reuse TCP/TLS connections across rows
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=HTTP_POOL_SIZE,
+        pool_maxsize=HTTP_POOL_SIZE,
+        max_retries=Retry(total=3, backoff_factor=0.3),
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+HTTP_SESSION = _build_http_session()
 
 
 def _read_json_rows(json_path):
     rows = []
+    seen = set()
     with open(json_path, encoding="utf-8") as handle:
         data = json.load(handle)
         # Handle both array of objects and single object
@@ -40,60 +97,102 @@ def _read_json_rows(json_path):
             file_url = (item.get("file_url") or "").strip()
             if not conference_uuid or not file_url:
                 continue
+            if DEDUPLICATE_BY_CONFERENCE_UUID:
+                if conference_uuid in seen:
+                    continue
+                seen.add(conference_uuid)
             rows.append(
                 {
                     "conference_uuid": conference_uuid,
                     "file_url": file_url,
                 }
             )
+            if len(rows) == MAX_ROWS:
+                break
 
-    if DEDUPLICATE_BY_CONFERENCE_UUID:
-        seen = set()
-        deduped = []
-        for row in rows:
-            if row["conference_uuid"] in seen:
-                continue
-            seen.add(row["conference_uuid"])
-            deduped.append(row)
-        rows = deduped
+    return rows
 
-    return rows[:MAX_ROWS]
 
-
-def _prepare_temp_dir(temp_dir):
-    os.makedirs(temp_dir, exist_ok=True)
-    for filename in os.listdir(temp_dir):
-        path = os.path.join(temp_dir, filename)
-        if os.path.isfile(path):
-            os.remove(path)
-
-
-def _download_image(url, dest_path):
-    response = requests.get(url, headers=OPTIONAL_HEADERS, timeout=30)
+def _download_image(url):
+    response = HTTP_SESSION.get(url, headers=OPTIONAL_HEADERS, timeout=30)
     response.raise_for_status()
-    with open(dest_path, "wb") as handle:
-        handle.write(response.content)
+    return response.content
 
 
 def _s3_cleanup_prefix(s3_client, bucket, prefix):
     paginator = s3_client.get_paginator("list_objects_v2")
-    to_delete = []
-    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
-        for obj in page.get("Contents", []):
-            to_delete.append({"Key": obj["Key"]})
-            if len(to_delete) == 1000:
-                s3_client.delete_objects(Bucket=bucket, Delete={"Objects": to_delete})
-                to_delete = []
-    if to_delete:
-        s3_client.delete_objects(Bucket=bucket, Delete={"Objects": to_delete})
-
-
-def _upload_image(s3_client, bucket, key, file_path):
-    s3_client.upload_file(
-        file_path,
+    batches = []
+    for page in paginator.paginate(
+        Bucket=bucket,
+        Prefix=prefix,
+        PaginationConfig={"PageSize": 1000},
+    ):
+        keys = [{"Key": obj["Key"]} for obj in page.get("Contents", [])]
+        # PageSize caps each page at delete_objects' 1000-key limit
+        if keys:
+            batches.append(keys)
+
+    if not batches:
+        return
+
+    def _delete_batch(batch):
+        return s3_client.delete_objects(
+            Bucket=bucket,
+            Delete={"Objects": batch, "Quiet": True},
+        )
+
+    # Batches are independent, so issue the deletes concurrently
+    with ThreadPoolExecutor(max_workers=CLEANUP_WORKERS) as executor:
+        list(executor.map(_delete_batch, batches))
+
+
+def _cv2_encode_jpeg(img):
+    ok, buf = cv2.imencode(".jpg", img, JPEG_ENCODE_PARAMS)
+    if not ok:
+        raise Exception("Failed to encode crop as JPEG")
+    return buf.tobytes()
+
+
+def _turbo_encode_jpeg(turbo, img):
+    # Crops are views into the decoded image; turbojpeg wants contiguous rows.
+    # optimize() rewrites the Huffman tables, matching IMWRITE_JPEG_OPTIMIZE.
+    return turbo.optimize(
+        turbo.encode(
+            np.ascontiguousarray(img),
+            quality=JPEG_QUALITY,
+            pixel_format=TJPF_BGR,
+            jpeg_subsample=TJSAMP_420,
+        )
+    )
+
+
+def _make_jpeg_encoder():
+    """Return a crop -> JPEG bytes function, using turbojpeg when it loads."""
+    # Needs PyTurboJPEG plus the native libturbojpeg; OpenCV is the fallback
+    if TurboJPEG is None:
+        return _cv2_encode_jpeg
+    try:
+        turbo = TurboJPEG()
+    except Exception as exc:
+        print("Warning: turbojpeg unavailable, encoding with OpenCV: {}".format(exc))
+        return _cv2_encode_jpeg
+    if not hasattr(turbo, "optimize"):
+        print("Warning: PyTurboJPEG has no optimize(), encoding with OpenCV")
+        return _cv2_encode_jpeg
+
+    def encode(img):
+        return _turbo_encode_jpeg(turbo, img)
+
+    return encode
+
+
+def _upload_image(s3_client, bucket, key, data):
+    s3_client.upload_fileobj(
+        io.BytesIO(data),
         bucket,
         key,
         ExtraArgs={"ContentType": "image/jpeg"},
+        Config=TRANSFER_CONFIG,
     )
 
 
@@ -113,6 +212,25 @@ def _write_outputs(base_dir, output_rows):
         json.dump(output_rows, handle, ensure_ascii=True, indent=2)
 
 
+def _read_model_hits(base_dir):
+    json_path = os.path.join(base_dir, MODEL_STATS_FILENAME)
+    if not os.path.isfile(json_path):
+        return {}
+    try:
+        with open(json_path, encoding="utf-8") as handle:
+            data = json.load(handle)
+        return {str(model_num): int(hits) for model_num, hits in data.items()}
+    except (OSError, AttributeError, TypeError, ValueError) as exc:
+        print("Warning: Could not read {}: {}".format(json_path, exc))
+        return {}
+
+
+def _write_model_hits(base_dir, hits):
+    json_path = os.path.join(base_dir, MODEL_STATS_FILENAME)
+    with open(json_path, "w", encoding="utf-8") as handle:
+        json.dump(hits, handle, ensure_ascii=True, indent=2, sort_keys=True)
+
+
 def _find_crop_models(base_dir):
     """Find all crop_model*.py files in the base directory."""
     pattern = os.path.join(base_dir, "crop_model*.py")
@@ -135,30 +253,60 @@ def _load_crop_module(model_file):
     return module
 
 
-def _compare_ssim(image1_path, image2_path, resize=True):
-    """Compare two images using SSIM (grayscale)."""
-    img1 = cv2.imread(image1_path)
-    img2 = cv2.imread(image2_path)
+def _load_crop_models(base_dir):
+    """Load every crop model once; return [(model_num, module), ...]."""
+    crop_modules = []
+    for model_num, model_file in _find_crop_models(base_dir):
+        try:
+            crop_modules.append((model_num, _load_crop_module(model_file)))
+        except Exception as exc:
+            print("Error loading model {}: {}".format(model_num, exc))
+    return crop_modules
 
-    if img1 is None:
-        raise FileNotFoundError("Could not read image: {}".format(image1_path))
-    if img2 is None:
-        raise FileNotFoundError("Could not read image: {}".format(image2_path))
 
-    # Resize if needed
-    if resize and img1.shape[:2] != img2.shape[:2]:
-        img2 = cv2.resize(
-            img2,
-            (img1.shape[1], img1.shape[0]),
-            interpolation=cv2.INTER_AREA,
-        )
+def _mask_path_for_model(model_num):
+    mask_image_path = os.path.join(MASKS_DIR, "mask_{}.jpg".format(model_num))
+    if not os.path.isfile(mask_image_path):
+        mask_image_path = os.path.join(MASKS_DIR, "mask_{}.JPG".format(model_num))
+    if not os.path.isfile(mask_image_path):
+        return None
+    return mask_image_path
 
-    # Convert to grayscale
-    gray1 = cv2.cvtColor(img1, cv2.COLOR_BGR2GRAY)
-    gray2 = cv2.cvtColor(img2, cv2.COLOR_BGR2GRAY)
 
-    # Calculate SSIM
-    score = ssim(gray1, gray2, data_range=255)
+def _load_masks(crop_modules):
+    """
+    Read each model's mask once and precompute everything SSIM needs from it.
+    Returns {model_num: {"shape": (h, w), "stats": ssim_stats(...)}}.
+    """
+    masks = {}
+    for model_num, _ in crop_modules:
+        mask_image_path = _mask_path_for_model(model_num)
+        if mask_image_path is None:
+            print("Warning: Mask image not found: mask_{}.jpg/JPG".format(model_num))
+            continue
+        mask = cv2.imread(mask_image_path)
+        if mask is None:
+            print("Warning: Could not read mask image: {}".format(mask_image_path))
+            continue
+        mask_gray = cv2.cvtColor(mask, cv2.COLOR_BGR2GRAY)
+        masks[model_num] = {
+            "shape": mask_gray.shape[:2],
+            "stats": ssim_stats(downsample_for_ssim(mask_gray)),
+        }
+    return masks
+
+
+def _compare_ssim(mask, crop_bgr, resize=True):
+    """Compare a preloaded mask (see _load_masks) against a BGR crop using SSIM."""
+    gray2 = cv2.cvtColor(crop_bgr, cv2.COLOR_BGR2GRAY)
+
+    # Resize if needed
+    mask_h, mask_w = mask["shape"]
+    if resize and (mask_h, mask_w) != gray2.shape[:2]:
+        gray2 = cv2.resize(gray2, (mask_w, mask_h), interpolation=cv2.INTER_LINEAR)
+
+    # Calculate SSIM on the block-reduced crop; mask statistics are reused
+    score = fast_ssim_with_stats(mask["stats"], downsample_for_ssim(gray2))
     return score
 
 
@@ -183,58 +331,113 @@ def _di_type_from_model(model_num):
     return None
 
 
-def _find_best_crop(input_path, base_dir, conference_uuid):
-    """Try all crop models and return (best_crop_path, best_model_num, best_score)."""
-    models = _find_crop_models(base_dir)
-
-    if not models:
-        raise Exception("No crop_model*.py files found in {}".format(base_dir))
-
+def _find_best_crop(img, crop_modules, masks, conference_uuid):
+    """Try all crop models and return (best_crop, best_model_num, best_score)."""
     best_score = -1.0
-    best_crop_path = None
+    best_crop = None
     best_model_num = None
-    temp_crops = []
 
-    for model_num, model_file in models:
+    for model_num, crop_module in crop_modules:
         try:
-            crop_module = _load_crop_module(model_file)
-
-            crop_path = os.path.join(
-                TEMP_DIR, "{}_model{}_cropped.jpg".format(conference_uuid, model_num)
-            )
-            temp_crops.append(crop_path)
-
-            crop_module.crop_image(input_path, crop_path)
-
-            mask_image_path = os.path.join(MASKS_DIR, "mask_{}.jpg".format(model_num))
-            if not os.path.isfile(mask_image_path):
-                mask_image_path = os.path.join(MASKS_DIR, "mask_{}.JPG".format(model_num))
-            if not os.path.isfile(mask_image_path):
-                print("Warning: Mask image not found: mask_{}.jpg/JPG".format(model_num))
+            mask = masks.get(model_num)
+            if mask is None:
                 continue
 
-            score = _compare_ssim(mask_image_path, crop_path, resize=True)
-            print("Model {} similarity: {:.4f}".format(model_num, score))
+            # Crops stay in memory; only the winner is written to disk
+            crop = crop_module.crop_image_from_array(img)
+
+            score = _compare_ssim(mask, crop, resize=True)
+            print(
+                "[{}] Model {} similarity: {:.4f}".format(
+                    conference_uuid, model_num, score
+                )
+            )
 
             if score > best_score:
                 best_score = score
-                best_crop_path = crop_path
+                best_crop = crop
                 best_model_num = model_num
 
+            if (
+                EARLY_EXIT_THRESHOLD is not None
+                and best_score >= EARLY_EXIT_THRESHOLD
+            ):
+                break
+
         except Exception as exc:
-            print("Error processing model {}: {}".format(model_num, exc))
+            print(
+                "[{}] Error processing model {}: {}".format(
+                    conference_uuid, model_num, exc
+                )
+            )
             continue
 
-    if best_crop_path is None:
+    if best_crop is None:
         raise Exception("No valid crop model produced a result")
 
-    for crop_path in temp_crops:
-        if crop_path != best_crop_path and os.path.isfile(crop_path):
-            os.remove(crop_path)
-            print("Deleted: {}".format(crop_path))
+    print(
+        "[{}] Best model: {} (similarity: {:.4f})".format(
+            conference_uuid, best_model_num, best_score
+        )
+    )
+    return best_crop, best_model_num, best_score
+
+
+def _fetch_row_image(row):
+    """Download a row's image and return the raw (still encoded) bytes."""
+    print("[{}] Downloading {}...".format(row["conference_uuid"], row["file_url"]))
+    return _download_image(row["file_url"])
+
+
+def _make_prefetcher(executor, rows, depth):
+    """
+    Return fetch(index) -> downloaded bytes of rows[index].
 
-    print("Best model: {} (similarity: {:.4f})".format(best_model_num, best_score))
-    return best_crop_path, best_model_num, best_score
+    Each fetch also queues the download of rows[index + depth], so downloads
+    run a bounded distance ahead of the crop workers, and a body is dropped
+    from here as soon as its row takes it.
+    """
+    futures = {}
+    submitted = set()
+    lock = threading.Lock()
+
+    def _submit(index):
+        if index < len(rows) and index not in submitted:
+            submitted.add(index)
+            futures[index] = executor.submit(_fetch_row_image, rows[index])
+
+    with lock:
+        for index in range(depth):
+            _submit(index)
+
+    def fetch(index):
+        with lock:
+            _submit(index)
+            _submit(index + depth)
+            future = futures.pop(index)
+        return future.result()
+
+    return fetch
+
+
+def _process_row(crop_modules, masks, index, row, fetch_image, encode_jpeg):
+    """Crop a single downloaded row; return (key, jpeg_bytes, model, score)."""
+    key = "{}{}_cropped.jpg".format(PREFIX, row["conference_uuid"])
+
+    # Decode straight from memory once and share it across every crop model;
+    # the downloaded bytes are not kept past this point
+    # cv2.imdecode (rather than turbojpeg) applies the EXIF orientation that
+    # phone photos carry, which the proportional crop boxes depend on
+    img = cv2.imdecode(np.frombuffer(fetch_image(index), np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        raise Exception("Could not decode image: {}".format(row["file_url"]))
+
+    best_crop, best_model_num, best_score = _find_best_crop(
+        img, crop_modules, masks, row["conference_uuid"]
+    )
+
+    # Encode once in memory; the bytes are uploaded without touching disk
+    return key, encode_jpeg(best_crop), best_model_num, best_score
 
 
 def main():
@@ -249,10 +452,20 @@ def main():
         print("No valid rows to process in JSON.")
         return 1
 
-    _prepare_temp_dir(TEMP_DIR)
+    crop_modules = _load_crop_models(base_dir)
+    if not crop_modules:
+        print("No crop_model*.py files found in {}".format(base_dir))
+        return 1
+    masks = _load_masks(crop_modules)
+    encode_jpeg = _make_jpeg_encoder()
+
+    # Try the models that won most often in previous runs first, so an
+    # EARLY_EXIT_THRESHOLD, when set, triggers as soon as possible
+    model_hits = _read_model_hits(base_dir)
+    crop_modules.sort(key=lambda item: model_hits.get(item[0], 0), reverse=True)
 
     region = os.getenv("AWS_REGION") or os.getenv("AWS_DEFAULT_REGION") or "us-east-1"
-    s3_client = boto3.client("s3", region_name=region)
+    s3_client = boto3.client("s3", region_name=region, config=S3_CLIENT_CONFIG)
 
     print("Cleaning S3 prefix: s3://{}/{}".format(BUCKET_NAME, PREFIX))
     _s3_cleanup_prefix(s3_client, BUCKET_NAME, PREFIX)
@@ -260,47 +473,85 @@ def main():
     output_rows = []
     failures = []
 
-    for row in rows:
-        conference_uuid = row["conference_uuid"]
-        file_url = row["file_url"]
-        input_path = os.path.join(TEMP_DIR, "{}.jpg".format(conference_uuid))
-        output_path = os.path.join(TEMP_DIR, "{}_cropped.jpg".format(conference_uuid))
-        key = "{}{}_cropped.jpg".format(PREFIX, conference_uuid)
-
-        try:
-            print("Downloading {}...".format(file_url))
-            _download_image(file_url, input_path)
+    # Rows are independent and the cv2 crop + SSIM work releases the GIL, so
+    # a thread pool overlaps them. Downloads run on their own pool up to
+    # PREFETCH_ROWS rows ahead of the crop workers, and each finished crop is
+    # handed to a separate upload pool so PUTs don't serialize.
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as download_executor, \
+            ThreadPoolExecutor(max_workers=MAX_WORKERS) as row_executor, \
+            ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as upload_executor:
+        fetch_image = _make_prefetcher(download_executor, rows, PREFETCH_ROWS)
+        row_futures = {
+            row_executor.submit(
+                _process_row,
+                crop_modules,
+                masks,
+                index,
+                row,
+                fetch_image,
+                encode_jpeg,
+            ): (index, row)
+            for index, row in enumerate(rows)
+        }
+        upload_futures = {}
+
+        for future in as_completed(row_futures):
+            index, row = row_futures[future]
+            conference_uuid = row["conference_uuid"]
+            try:
+                key, data, best_model_num, best_score = future.result()
+            except Exception as exc:
+                failures.append(
+                    (index, {"conference_uuid": conference_uuid, "error": str(exc)})
+                )
+                print("Failed {}: {}".format(conference_uuid, exc))
+                continue
 
-            best_crop_path, best_model_num, best_score = _find_best_crop(
-                input_path, base_dir, conference_uuid
+            upload_future = upload_executor.submit(
+                _upload_image, s3_client, BUCKET_NAME, key, data
+            )
+            upload_futures[upload_future] = (
+                index,
+                conference_uuid,
+                key,
+                best_model_num,
+                best_score,
             )
 
-            # Rename best crop to the final output path if different
-            if best_crop_path != output_path:
-                if os.path.isfile(output_path):
-                    os.remove(output_path)
-                os.rename(best_crop_path, output_path)
-
-            _upload_image(s3_client, BUCKET_NAME, key, output_path)
-            cropped_url = _build_output_url(s3_client, BUCKET_NAME, key)
-
-            di_type_optimized = _di_type_from_model(best_model_num)
-
-            output_rows.append(
-                {
+        for future in as_completed(upload_futures):
+            index, conference_uuid, key, best_model_num, best_score = upload_futures[
+                future
+            ]
+            try:
+                future.result()
+                cropped_url = _build_output_url(s3_client, BUCKET_NAME, key)
+                output_row = {
                     "conference_uuid": conference_uuid,
                     "cropped_file_url": cropped_url,
-                    "di_type_optimized": di_type_optimized,
+                    "di_type_optimized": _di_type_from_model(best_model_num),
                     "best_model": str(best_model_num),
                     "ssim_score": round(float(best_score), 4),
                 }
-            )
+            except Exception as exc:
+                failures.append(
+                    (index, {"conference_uuid": conference_uuid, "error": str(exc)})
+                )
+                print("Failed {}: {}".format(conference_uuid, exc))
+                continue
+
+            output_rows.append((index, output_row))
             print("Uploaded: {}".format(key))
-        except Exception as exc:
-            failures.append({"conference_uuid": conference_uuid, "error": str(exc)})
-            print("Failed {}: {}".format(conference_uuid, exc))
+
+    # Work finishes out of order; restore the input order for the outputs
+    output_rows = [entry for _, entry in sorted(output_rows, key=lambda item: item[0])]
+    failures = [entry for _, entry in sorted(failures, key=lambda item: item[0])]
 
     _write_outputs(base_dir, output_rows)
+
+    for output_row in output_rows:
+        best_model = output_row["best_model"]
+        model_hits[best_model] = model_hits.get(best_model, 0) + 1
+    _write_model_hits(base_dir, model_hits)
     print(json.dumps(output_rows, ensure_ascii=True))
 
     if failures:
@@ -7,28 +7,26 @@ def crop_image(input_path, output_path):
     if img is None:
         raise Exception("Could not read the image: {}".format(input_path))
 
+    crop_image_from_array(img, output_path)
+    return output_path
+
+
+def crop_image_from_array(img, output_path=None):
     h, w = img.shape[:2]
 
     # Proportional points (clockwise)
-    left = int(w * 0.08)
-    right = int(w * 0.43)
-    top = int(h * 0.22)
-    bottom = int(h * 0.345)
-
-    x_min = max(0, min(left, right))
-    y_min = max(0, min(top, bottom))
-    x_max = min(w, max(left, right))
-    y_max = min(h, max(top, bottom))
+    x_min, x_max = int(w * 0.08), int(w * 0.43)
+    y_min, y_max = int(h * 0.22), int(h * 0.345)
 
     if x_max <= x_min or y_max <= y_min:
-        raise Exception("Invalid crop coordinates for: {}".format(input_path))
+        raise Exception("Invalid crop coordinates for image of size {}x{}".format(w, h))
 
     crop = img[y_min:y_max, x_min:x_max]
 
-    if not cv2.imwrite(output_path, crop):
+    if output_path is not None and not cv2.imwrite(output_path, crop):
         raise Exception("Failed to write crop: {}".format(output_path))
 
-    return output_path
+    return crop
 
 
 def _batch_crop_temp():
@@ -14,9 +14,10 @@ def mask_regions(img):
 
     NOTE: Masking is currently DEACTIVATED in the pipeline (crop-only).
     The lines below are intentionally kept for future use.
+
+    Draws in place on img (and returns it); pass a copy if img must stay intact.
     """
     h, w = img.shape[:2]
-    out = img.copy()
 
     # (x1, y1, x2, y2) em porcentagem do tamanho da imagem
     rects = [
@@ -36,9 +37,9 @@ def mask_regions(img):
         y1 = int(y1p * h)
         x2 = int(x2p * w)
         y2 = int(y2p * h)
-        cv2.rectangle(out, (x1, y1), (x2, y2), (0, 0, 0), thickness=-1)
+        cv2.rectangle(img, (x1, y1), (x2, y2), (0, 0, 0), thickness=-1)
 
-    return out
+    return img
 
 
 def crop_image(input_path, output_path, apply_mask=False):
@@ -50,32 +51,32 @@ def crop_image(input_path, output_path, apply_mask=False):
     if img is None:
         raise Exception("Could not read the image: {}".format(input_path))
 
+    crop_image_from_array(img, output_path, apply_mask=apply_mask)
+    return output_path
+
+
+def crop_image_from_array(img, output_path=None, apply_mask=False):
+    """Like crop_image, but takes a decoded image and returns the crop array."""
     h, w = img.shape[:2]
 
     # Proportional crop region
-    left = int(w * 0.14)
-    right = int(w * 0.7)
-    top = int(h * 0.38)
-    bottom = int(h * 0.487)
-
-    x_min = max(0, min(left, right))
-    y_min = max(0, min(top, bottom))
-    x_max = min(w, max(left, right))
-    y_max = min(h, max(top, bottom))
+    x_min, x_max = int(w * 0.14), int(w * 0.7)
+    y_min, y_max = int(h * 0.38), int(h * 0.487)
 
     if x_max <= x_min or y_max <= y_min:
-        raise Exception("Invalid crop coordinates for: {}".format(input_path))
+        raise Exception("Invalid crop coordinates for image of size {}x{}".format(w, h))
 
     crop = img[y_min:y_max, x_min:x_max]
 
     # Masking is deactivated by default; keep function available for later.
+    # crop is a view into img (shared across models), so copy once before masking
     if apply_mask:
-        crop = mask_regions(crop)
+        crop = mask_regions(crop.copy())
 
-    if not cv2.imwrite(output_path, crop):
+    if output_path is not None and not cv2.imwrite(output_path, crop):
         raise Exception("Failed to write crop: {}".format(output_path))
 
-    return output_path
+    return crop
 
 
 def _batch_crop_temp():